@@ -8,95 +8,232 @@ Input: JSON payload on stdin, usually forwarded by langfuse_plugin.js:
   "captured_at": "...",
   "event": { "type": "...", "properties": {...} }
 }
+
+State lives under ~/.config/opencode/state/langfuse, sharded per session in
+sessions/<hash>/<session>.{json,log,lock}: each event appends its deltas to the
+session journal (.log), which is replayed over the .json snapshot on load and
+folded back into it once it exceeds OPENCODE_LANGFUSE_JOURNAL_MAX_BYTES.
+Each session's last lifecycle marker is kept in its own state. The single
+state.json used before sharding is removed, not migrated, by the flusher.
+
+Emission: the hook itself never imports langfuse. Completed turns and
+lifecycle events are queued to outbox.jsonl, and a detached
+`langfuse_hook.py --flush` process (one at a time, serialized on flush.lock)
+drains the outbox, builds a single Langfuse client, emits and flushes.
+
+Durability: this is a best-effort observability sidecar, so by default session
+snapshots are rewritten in place and nothing is fsynced; a crash may lose the
+last few events or leave a torn snapshot. Set OPENCODE_LANGFUSE_DURABLE=1 to
+fsync journal appends and write snapshots via fsynced temp file + rename.
 """
 
 from __future__ import annotations
 
+import atexit
 import hashlib
+import importlib.util
 import json
 import os
+import re
 import socket
+import subprocess
 import sys
+import threading
+import time
+from collections import Counter
 from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from typing import IO, Any, Callable, Dict, List, Optional, Tuple
 
 try:
     import fcntl  # type: ignore
 except Exception:  # pragma: no cover
     fcntl = None
 
+try:
+    import orjson  # type: ignore
+except Exception:  # pragma: no cover
+    orjson = None
+
 
 CONFIG_DIR = Path.home() / ".config" / "opencode"
 STATE_DIR = CONFIG_DIR / "state" / "langfuse"
-STATE_FILE = STATE_DIR / "state.json"
-STATE_LOCK_FILE = STATE_DIR / "state.lock"
+SESSIONS_DIR = STATE_DIR / "sessions"
+LEGACY_STATE_FILES = (STATE_DIR / "state.json", STATE_DIR / "state.tmp", STATE_DIR / "state.lock")
+OUTBOX_FILE = STATE_DIR / "outbox.jsonl"
+OUTBOX_LOCK_FILE = STATE_DIR / "outbox.lock"
+FLUSH_LOCK_FILE = STATE_DIR / "flush.lock"
+FLUSH_SPAWNED_FILE = STATE_DIR / "flush.spawned"
 LOG_FILE = STATE_DIR / "langfuse_hook.log"
 MAX_CHARS = int(os.environ.get("OPENCODE_LANGFUSE_MAX_CHARS", "20000"))
 MAX_MESSAGE_EVENTS_PER_MESSAGE = int(os.environ.get("OPENCODE_LANGFUSE_MAX_MESSAGE_EVENTS_PER_MESSAGE", "30"))
 
+FLUSH_RESPAWN_SECONDS = 2.0
+_O_BINARY = getattr(os, "O_BINARY", 0)  # Windows: no newline translation on raw fds
 _LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARN": 30, "WARNING": 30, "ERROR": 40}
+_SESSION_STATE_KEYS = (
+    "messages",
+    "message_events",
+    "user_parts",
+    "assistant_parts",
+    "assistant_finish_seen",
+    "pending_parts",
+    "message_last_seen",
+    "part_last_seen",
+    "emitted",
+    "lifecycle",
+)
+_FLUSH_EVENTS = frozenset({"session.idle", "session.error", "session.compacted"})
+_STATE_SAVED_LOG_KEYS = (
+    "messages",
+    "message_events",
+    "user_parts",
+    "assistant_parts",
+    "assistant_finish_seen",
+    "pending_parts",
+    "emitted",
+)
+_SAFE_SESSION_NAME = re.compile(r"^[A-Za-z0-9_-]{1,128}$")
+
+
+# orjson parses/encodes state several times faster than stdlib json; fall back
+# to stdlib when it is not installed. Both helpers work on UTF-8 bytes, and
+# values the encoder cannot handle are stringified in place via default=str.
+if orjson is not None:
+
+    def _json_loads(data: bytes) -> Any:
+        return orjson.loads(data)
+
+    def _json_dumps(value: Any) -> bytes:
+        return orjson.dumps(value, default=str, option=orjson.OPT_NON_STR_KEYS)
+
+else:
+
+    def _json_loads(data: bytes) -> Any:
+        return json.loads(data)
+
+    def _json_dumps(value: Any) -> bytes:
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8")
+
+
+def _env_log_level() -> int:
+    if os.environ.get("OPENCODE_LANGFUSE_DEBUG", "").strip().lower() in ("1", "true", "yes", "on"):
+        return _LOG_LEVELS["DEBUG"]
+    env_level = os.environ.get("OPENCODE_LANGFUSE_LOG_LEVEL", "INFO").strip().upper()
+    return _LOG_LEVELS.get(env_level, _LOG_LEVELS["INFO"])
+
+
+def _env_journal_max_bytes() -> int:
+    try:
+        return int(os.environ.get("OPENCODE_LANGFUSE_JOURNAL_MAX_BYTES", "262144"))
+    except ValueError:
+        return 262144
+
+
+def _env_durable() -> bool:
+    return os.environ.get("OPENCODE_LANGFUSE_DURABLE", "").strip().lower() in ("1", "true", "yes", "on")
+
+
+# Resolved once at import and again after .env is loaded, not per call.
+# Read these as module globals at call time, never as default arguments.
+_LOG_LEVEL = _env_log_level()
+_USER_ID = os.environ.get("LANGFUSE_USER_ID", "opencode-user")
+JOURNAL_MAX_BYTES = _env_journal_max_bytes()
+DURABLE = _env_durable()
+
+_HOSTNAME = socket.gethostname()
+
+
+def _refresh_env_settings() -> None:
+    global _LOG_LEVEL, _USER_ID, JOURNAL_MAX_BYTES, DURABLE
+    _LOG_LEVEL = _env_log_level()
+    _USER_ID = os.environ.get("LANGFUSE_USER_ID", "opencode-user")
+    JOURNAL_MAX_BYTES = _env_journal_max_bytes()
+    DURABLE = _env_durable()
+
+
+_DOTENV_LOADED = False
 
 
 def _load_dotenv() -> None:
+    global _DOTENV_LOADED
+    _DOTENV_LOADED = True
     env_path = CONFIG_DIR / ".env"
     try:
-        if not env_path.exists():
-            return
-        for line in env_path.read_text(encoding="utf-8").splitlines():
-            line = line.strip()
-            if not line or line.startswith("#") or "=" not in line:
-                continue
-            key, value = line.split("=", 1)
-            key = key.strip()
-            value = value.strip().strip("'\"")
-            if key and key not in os.environ:
-                os.environ[key] = value
+        if env_path.exists():
+            for line in env_path.read_text(encoding="utf-8").splitlines():
+                line = line.strip()
+                if not line or line.startswith("#") or "=" not in line:
+                    continue
+                key, value = line.split("=", 1)
+                key = key.strip()
+                value = value.strip().strip("'\"")
+                if key and key not in os.environ:
+                    os.environ[key] = value
     except Exception:
         pass
+    _refresh_env_settings()
 
 
-def _log(level: str, message: str) -> None:
-    level_name = str(level or "INFO").strip().upper()
-    level_value = _LOG_LEVELS.get(level_name, _LOG_LEVELS["INFO"])
+def _debug_enabled() -> bool:
+    # Guard for DEBUG lines on per-event paths, so their f-strings are not
+    # built when they would be dropped anyway.
+    return _LOG_LEVEL <= _LOG_LEVELS["DEBUG"]
+
+
+_log_fh: Optional[IO[str]] = None
+_log_fh_lock = threading.Lock()
+
+
+def _close_log() -> None:
+    if _log_fh is not None:
+        try:
+            _log_fh.close()
+        except Exception:
+            pass
 
-    env_level = os.environ.get("OPENCODE_LANGFUSE_LOG_LEVEL", "INFO").strip().upper()
-    env_value = _LOG_LEVELS.get(env_level, _LOG_LEVELS["INFO"])
-    debug_enabled = os.environ.get("OPENCODE_LANGFUSE_DEBUG", "").strip().lower() in ("1", "true", "yes", "on")
-    if debug_enabled:
-        env_value = _LOG_LEVELS["DEBUG"]
 
-    if level_value < env_value:
+def _log(level: str, message: str) -> None:
+    global _log_fh
+    level_value = _LOG_LEVELS.get(level, _LOG_LEVELS["INFO"])
+    if level_value < _LOG_LEVEL:
         return
     try:
-        STATE_DIR.mkdir(parents=True, exist_ok=True)
-        with LOG_FILE.open("a", encoding="utf-8") as f:
-            f.write(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} [{level_name}] {message}\n")
+        if _log_fh is None:
+            with _log_fh_lock:
+                if _log_fh is None:
+                    STATE_DIR.mkdir(parents=True, exist_ok=True)
+                    # Line-buffered O_APPEND: each line is one write, atomic across processes.
+                    _log_fh = LOG_FILE.open("a", encoding="utf-8", buffering=1)
+                    atexit.register(_close_log)
+        _log_fh.write(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} [{level}] {message}\n")
     except Exception:
         pass
 
 
+# Longest marker _cut can append; strings within this much of the limit were
+# already cut (e.g. at ingest) and are left alone.
+_MARKER_SLACK = len(f"\n...[truncated {sys.maxsize} chars]")
+
+
+def _cut(value: str, limit: int) -> str:
+    return value[:limit] + f"\n...[truncated {len(value) - limit} chars]"
+
+
 def _truncate(value: Any, limit: int = MAX_CHARS) -> Any:
     if not isinstance(value, str):
         return value
-    if len(value) <= limit:
+    if len(value) <= limit + _MARKER_SLACK:
         return value
-    return value[:limit] + f"\n...[truncated {len(value) - limit} chars]"
+    return _cut(value, limit)
 
 
 def _as_dict(value: Any) -> Dict[str, Any]:
     return value if isinstance(value, dict) else {}
 
 
-def _safe_json(value: Any) -> Any:
-    try:
-        json.dumps(value)
-        return value
-    except Exception:
-        return str(value)
-
-
 def _parse_dt(value: Any) -> Optional[datetime]:
     if value is None:
         return None
@@ -106,21 +243,34 @@ def _parse_dt(value: Any) -> Optional[datetime]:
             return datetime.fromtimestamp(float(value) / 1000.0, tz=timezone.utc)
         return datetime.fromtimestamp(float(value), tz=timezone.utc)
     if isinstance(value, str):
-        v = value.strip()
-        if not v:
-            return None
-        try:
-            if v.endswith("Z"):
-                return datetime.fromisoformat(v[:-1] + "+00:00")
-            dt = datetime.fromisoformat(v)
-            if dt.tzinfo is None:
-                return dt.replace(tzinfo=timezone.utc)
-            return dt
-        except Exception:
-            return None
+        return _parse_dt_str(value)
     return None
 
 
+@lru_cache(maxsize=4096)
+def _parse_dt_str(value: str) -> Optional[datetime]:
+    v = value.strip()
+    if not v:
+        return None
+    try:
+        if v.endswith("Z"):
+            return datetime.fromisoformat(v[:-1] + "+00:00")
+        dt = datetime.fromisoformat(v)
+        if dt.tzinfo is None:
+            return dt.replace(tzinfo=timezone.utc)
+        return dt
+    except Exception:
+        return None
+
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def _dt_ns(dt: datetime) -> int:
+    # Exact integer arithmetic; dt.timestamp() * 1e9 would round.
+    return (dt - _EPOCH) // timedelta(microseconds=1) * 1000
+
+
 def _iso_now() -> str:
     return datetime.now(timezone.utc).isoformat()
 
@@ -130,18 +280,19 @@ def _msg_key(session_id: str, message_id: str) -> str:
 
 
 def _turn_key(session_id: str, message_id: str) -> str:
-    raw = f"{session_id}:{message_id}"
-    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:24]
+    # Persisted dedup key: it must not depend on which optional packages are
+    # installed, or emitted lookups would miss after an install/uninstall.
+    return hashlib.blake2b(f"{session_id}:{message_id}".encode("utf-8"), digest_size=12).hexdigest()
 
 
 @contextmanager
-def _state_lock():
+def _file_lock(lock_file: Path):
     lock_fd = None
     locked = False
     try:
         if fcntl is not None:
-            STATE_DIR.mkdir(parents=True, exist_ok=True)
-            lock_fd = STATE_LOCK_FILE.open("a+", encoding="utf-8")
+            lock_file.parent.mkdir(parents=True, exist_ok=True)
+            lock_fd = lock_file.open("a+", encoding="utf-8")
             fcntl.flock(lock_fd.fileno(), fcntl.LOCK_EX)
             locked = True
     except Exception:
@@ -168,67 +319,294 @@ def _state_lock():
                 pass
 
 
-def _load_state() -> Dict[str, Any]:
+def _session_path(session_id: str, suffix: str) -> Path:
+    # Fan out by hash prefix so a long-lived workspace does not pile every
+    # session into one directory. Unsafe ids fall back to the full digest.
+    digest = hashlib.sha1(session_id.encode("utf-8")).hexdigest()
+    name = session_id if _SAFE_SESSION_NAME.match(session_id) else digest
+    return SESSIONS_DIR / digest[:2] / f"{name}{suffix}"
+
+
+def _state_lock(session_id: str):
+    return _file_lock(_session_path(session_id, ".lock"))
+
+
+def _blank_session_state() -> Dict[str, Any]:
+    return {k: {} for k in _SESSION_STATE_KEYS}
+
+
+def _load_snapshot(snapshot_file: Path) -> Dict[str, Any]:
     try:
-        if not STATE_FILE.exists():
-            return {
-                "messages": {},
-                "message_events": {},
-                "user_parts": {},
-                "assistant_parts": {},
-                "assistant_finish_seen": {},
-                "pending_parts": {},
-                "message_last_seen": {},
-                "part_last_seen": {},
-                "emitted": {},
-                "session_lifecycle": {},
-            }
-        data = json.loads(STATE_FILE.read_text(encoding="utf-8"))
+        if not snapshot_file.exists():
+            return _blank_session_state()
+        data = _json_loads(snapshot_file.read_bytes())
         if isinstance(data, dict):
-            data.setdefault("messages", {})
-            data.setdefault("message_events", {})
-            data.setdefault("user_parts", {})
-            data.setdefault("assistant_parts", {})
-            data.setdefault("assistant_finish_seen", {})
-            data.setdefault("pending_parts", {})
-            data.setdefault("message_last_seen", {})
-            data.setdefault("part_last_seen", {})
-            data.setdefault("emitted", {})
-            data.setdefault("session_lifecycle", {})
             return data
     except Exception:
         pass
-    return {
-        "messages": {},
-        "message_events": {},
-        "user_parts": {},
-        "assistant_parts": {},
-        "assistant_finish_seen": {},
-        "pending_parts": {},
-        "message_last_seen": {},
-        "part_last_seen": {},
-        "emitted": {},
-        "session_lifecycle": {},
-    }
+    return _blank_session_state()
 
 
-def _save_state(state: Dict[str, Any]) -> None:
+def _write_snapshot(snapshot_file: Path, data: Dict[str, Any]) -> bool:
     try:
-        STATE_DIR.mkdir(parents=True, exist_ok=True)
-        tmp = STATE_FILE.with_suffix(".tmp")
-        tmp.write_text(json.dumps(state, ensure_ascii=False, indent=2), encoding="utf-8")
-        os.replace(tmp, STATE_FILE)
+        snapshot_file.parent.mkdir(parents=True, exist_ok=True)
+        raw = _json_dumps(data)
+        if not DURABLE:
+            snapshot_file.write_bytes(raw)
+            return True
+        tmp = snapshot_file.with_suffix(".tmp")
+        with tmp.open("wb", buffering=0) as f:
+            f.write(raw)
+            os.fsync(f.fileno())
+        os.replace(tmp, snapshot_file)
+        return True
+    except Exception:
+        return False
+
+
+def _append_bytes(path: Path, data: bytes) -> int:
+    """Append prebuilt bytes with one unbuffered O_APPEND write; returns the new file size."""
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | _O_BINARY, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+        if DURABLE:
+            os.fsync(fd)
+        return os.fstat(fd).st_size
+    finally:
+        os.close(fd)
+
+
+def _save_session_state(session_id: str, state: Dict[str, Any]) -> bool:
+    return _write_snapshot(_session_path(session_id, ".json"), state)
+
+
+# Handlers mutate state through _state_set/_state_del/_state_append, which
+# apply the change in memory and queue a small delta record. _commit_state
+# appends the queued deltas to the session journal instead of rewriting the
+# snapshot; _load_session_state replays them on top of the last snapshot.
+_pending_deltas: List[Dict[str, Any]] = []
+
+
+def _apply_delta(state: Dict[str, Any], rec: Dict[str, Any]) -> None:
+    path = rec.get("path")
+    if not isinstance(path, list) or not path:
+        return
+    container = state
+    for name in path[:-1]:
+        child = container.get(name)
+        if not isinstance(child, dict):
+            child = {}
+            container[name] = child
+        container = child
+    leaf = path[-1]
+    op = rec.get("op")
+    if op == "set":
+        container[leaf] = rec.get("value")
+    elif op == "del":
+        container.pop(leaf, None)
+    elif op == "append":
+        items = container.get(leaf)
+        if not isinstance(items, list):
+            items = []
+        items.append(rec.get("value"))
+        limit = rec.get("limit")
+        if isinstance(limit, int) and len(items) > limit:
+            items = items[-limit:]
+        container[leaf] = items
+
+
+def _record_delta(state: Dict[str, Any], rec: Dict[str, Any]) -> None:
+    _apply_delta(state, rec)
+    _pending_deltas.append(rec)
+
+
+def _state_set(state: Dict[str, Any], path: Tuple[str, ...], value: Any) -> None:
+    _record_delta(state, {"op": "set", "path": list(path), "value": value})
+
+
+def _state_del(state: Dict[str, Any], path: Tuple[str, ...]) -> None:
+    _record_delta(state, {"op": "del", "path": list(path)})
+
+
+def _state_append(state: Dict[str, Any], path: Tuple[str, ...], value: Any, limit: int) -> None:
+    _record_delta(state, {"op": "append", "path": list(path), "value": value, "limit": limit})
+
+
+def _load_session_state(session_id: str) -> Dict[str, Any]:
+    state = _load_snapshot(_session_path(session_id, ".json"))
+    journal_file = _session_path(session_id, ".log")
+    try:
+        if journal_file.exists():
+            for line in journal_file.read_bytes().splitlines():
+                if not line.strip():
+                    continue
+                try:
+                    rec = _json_loads(line)
+                except Exception:
+                    # Torn record from an interrupted hook; every batch starts on
+                    # a fresh line, so only that record is lost.
+                    continue
+                if isinstance(rec, dict):
+                    _apply_delta(state, rec)
     except Exception:
         pass
+    # Every top-level section is a dict from here on, so handlers index
+    # state[...] directly instead of coercing each read.
+    for k in _SESSION_STATE_KEYS:
+        if not isinstance(state.get(k), dict):
+            state[k] = {}
+    return state
+
+
+def _commit_state(session_id: str, state: Dict[str, Any]) -> None:
+    """Append queued deltas to the session journal; compact it into the snapshot when it grows large."""
+    if not _pending_deltas:
+        return
+    journal_file = _session_path(session_id, ".log")
+    try:
+        journal_file.parent.mkdir(parents=True, exist_ok=True)
+        # Lead with a newline so a torn tail left by an interrupted hook ends
+        # there instead of swallowing this batch's first record.
+        data = b"\n" + b"".join(_json_dumps(rec) + b"\n" for rec in _pending_deltas)
+        size = _append_bytes(journal_file, data)
+        if size > JOURNAL_MAX_BYTES and _save_session_state(session_id, state):
+            with journal_file.open("wb"):
+                pass
+            _log("DEBUG", f"state journal compacted session={session_id} bytes={size}")
+    except Exception:
+        pass
+    finally:
+        del _pending_deltas[:]
+
+
+_pending_jobs: List[Dict[str, Any]] = []
+
+
+def _queue_job(job: Dict[str, Any]) -> None:
+    _pending_jobs.append(job)
+
+
+def _commit_outbox() -> bool:
+    """Append queued emission jobs to the outbox; returns True when a flusher is needed."""
+    if not _pending_jobs:
+        return False
+    try:
+        # Fresh line first, as for the journal: a torn tail must not eat a job.
+        data = b"\n" + b"".join(_json_dumps(job) + b"\n" for job in _pending_jobs)
+        with _file_lock(OUTBOX_LOCK_FILE):
+            try:
+                was_empty = OUTBOX_FILE.stat().st_size == 0
+            except FileNotFoundError:
+                was_empty = True
+            _append_bytes(OUTBOX_FILE, data)
+            if _flusher_running():
+                # It rechecks the outbox after releasing flush.lock, so this
+                # append is picked up even if it is already past its last claim.
+                return False
+            if was_empty:
+                return True
+            # A non-empty outbox with no flusher holding the lock means one
+            # was spawned and is still starting, so bursts share it. If that
+            # spawn was a while ago, assume the flusher died before locking.
+            try:
+                return time.time() - FLUSH_SPAWNED_FILE.stat().st_mtime > FLUSH_RESPAWN_SECONDS
+            except FileNotFoundError:
+                return True
+    except Exception as exc:
+        _log("ERROR", f"outbox write failed: {exc}")
+        return False
+    finally:
+        del _pending_jobs[:]
+
+
+def _flusher_running() -> bool:
+    """Probe flush.lock without blocking; True while a flusher holds it."""
+    if fcntl is None:
+        return False
+    try:
+        with FLUSH_LOCK_FILE.open("a+", encoding="utf-8") as fh:
+            try:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return True
+            fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+    except Exception:
+        pass
+    return False
+
+
+def _claim_outbox() -> List[Dict[str, Any]]:
+    jobs: List[Dict[str, Any]] = []
+    try:
+        with _file_lock(OUTBOX_LOCK_FILE):
+            if not OUTBOX_FILE.exists():
+                return jobs
+            raw = OUTBOX_FILE.read_bytes()
+            OUTBOX_FILE.unlink()
+    except Exception:
+        return jobs
+    for line in raw.splitlines():
+        if not line.strip():
+            continue
+        try:
+            job = _json_loads(line)
+        except Exception:
+            continue
+        if isinstance(job, dict):
+            jobs.append(job)
+    return jobs
+
+
+def _spawn_flusher() -> None:
+    kwargs: Dict[str, Any] = {
+        "stdin": subprocess.DEVNULL,
+        "stdout": subprocess.DEVNULL,
+        "stderr": subprocess.DEVNULL,
+        "close_fds": True,
+    }
+    if os.name == "nt":
+        kwargs["creationflags"] = getattr(subprocess, "DETACHED_PROCESS", 0) | getattr(subprocess, "CREATE_NEW_PROCESS_GROUP", 0)
+    else:
+        kwargs["start_new_session"] = True
+    try:
+        FLUSH_SPAWNED_FILE.touch()
+    except Exception:
+        pass
+    try:
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), "--flush"], **kwargs)
+    except Exception as exc:
+        _log("ERROR", f"flusher spawn failed: {exc}")
+
+
+def _cap_strings(value: Any, limit: int = MAX_CHARS) -> None:
+    # Tool outputs and text parts can be far larger than anything we emit;
+    # truncate them once at ingest so they never reach the state files.
+    if type(value) is dict:
+        items = value.items()
+    elif type(value) is list:
+        items = enumerate(value)
+    else:
+        return
+    for k, v in items:
+        tv = type(v)
+        if tv is str:
+            if len(v) > limit:
+                value[k] = _cut(v, limit)
+        elif tv is dict or tv is list:
+            _cap_strings(v, limit)
 
 
 def _read_payload() -> Dict[str, Any]:
     try:
-        raw = sys.stdin.read()
+        raw = sys.stdin.buffer.read()
         if not raw.strip():
             return {}
-        parsed = json.loads(raw)
+        parsed = _json_loads(raw)
         if isinstance(parsed, dict):
+            _cap_strings(parsed)
             return parsed
     except Exception:
         pass
@@ -255,22 +633,19 @@ def _event_props(payload: Dict[str, Any]) -> Dict[str, Any]:
 
 def _session_id(payload: Dict[str, Any]) -> str:
     props = _event_props(payload)
-    info = _as_dict(props.get("info"))
-    part = _as_dict(props.get("part"))
-
-    for candidate in (
-        props.get("sessionID"),
-        props.get("sessionId"),
-        info.get("sessionID"),
-        info.get("sessionId"),
-        info.get("id"),  # session.created/info.id
-        part.get("sessionID"),
-        payload.get("session_id"),
-        payload.get("sessionId"),
-    ):
-        if candidate:
-            return str(candidate)
-    return "unknown-session"
+    sid = props.get("sessionID") or props.get("sessionId")
+    if not sid:
+        info = props.get("info")
+        if isinstance(info, dict):
+            # session.created carries the session as info.id
+            sid = info.get("sessionID") or info.get("sessionId") or info.get("id")
+    if not sid:
+        part = props.get("part")
+        if isinstance(part, dict):
+            sid = part.get("sessionID")
+    if not sid:
+        sid = payload.get("session_id") or payload.get("sessionId")
+    return str(sid) if sid else "unknown-session"
 
 
 def _event_captured_at(payload: Dict[str, Any]) -> datetime:
@@ -284,24 +659,45 @@ def _event_captured_at(payload: Dict[str, Any]) -> datetime:
     return datetime.now(timezone.utc)
 
 
-def _is_older_event(last_seen: Dict[str, Any], key: str, event_dt: datetime) -> bool:
-    prev = _parse_dt(last_seen.get(key))
-    if prev is None:
-        return False
-    return event_dt < prev
+def _event_captured_ns(payload: Dict[str, Any]) -> int:
+    return _dt_ns(_event_captured_at(payload))
 
 
-def _build_client():
-    try:
-        from langfuse import Langfuse  # type: ignore
-    except Exception:
-        return None
+def _is_older_event(last_seen: Dict[str, Any], key: str, event_ns: int) -> bool:
+    prev = last_seen.get(key)
+    if type(prev) is not int:
+        return False
+    return event_ns < prev
+
 
+def _credentials() -> Optional[Tuple[str, str, str]]:
     public_key = os.environ.get("LANGFUSE_PUBLIC_KEY", "").strip()
     secret_key = os.environ.get("LANGFUSE_SECRET_KEY", "").strip()
     base_url = os.environ.get("LANGFUSE_BASE_URL", "").strip()
     if not public_key or not secret_key:
         return None
+    return public_key, secret_key, base_url
+
+
+def _sdk_available() -> bool:
+    # Locate the package without importing it: the hook stays import-free and
+    # skips all state work on hosts where the flusher could never send.
+    try:
+        return importlib.util.find_spec("langfuse") is not None
+    except Exception:
+        return False
+
+
+def _build_client():
+    creds = _credentials()
+    if creds is None:
+        return None
+    public_key, secret_key, base_url = creds
+
+    try:
+        from langfuse import Langfuse  # type: ignore
+    except Exception:
+        return None
 
     try:
         kwargs: Dict[str, Any] = {"public_key": public_key, "secret_key": secret_key}
@@ -320,124 +716,174 @@ def _build_client():
         return None
 
 
+_client: Any = None
+
+
+def _get_client():
+    """Build the Langfuse client on first use and reuse it for the rest of the process."""
+    global _client
+    if _client is None:
+        _client = _build_client()
+    return _client
+
+
+def _flush_client() -> None:
+    try:
+        _client.flush()
+    except Exception as exc:
+        _log("DEBUG", f"client flush failed: {exc}")
+
+
 def _extract_text_from_parts(parts_map: Dict[str, Any]) -> str:
     rows: List[Tuple[datetime, str, str]] = []
+    now = datetime.now(timezone.utc)
+    needs_sort = False
     for part in parts_map.values():
-        p = _as_dict(part)
-        if p.get("type") != "text":
+        if type(part) is not dict or part.get("type") != "text":
             continue
-        text = p.get("text")
+        text = part.get("text")
         if not isinstance(text, str) or not text:
             continue
-        ts = _parse_dt(_as_dict(p.get("time")).get("start")) or datetime.now(timezone.utc)
-        rows.append((ts, str(p.get("id") or ""), text))
-    rows.sort(key=lambda x: (x[0], x[1]))
+        time_obj = part.get("time")
+        ts = (_parse_dt(time_obj.get("start")) if type(time_obj) is dict else None) or now
+        row = (ts, str(part.get("id") or ""), text)
+        if rows and row[:2] < rows[-1][:2]:
+            needs_sort = True
+        rows.append(row)
+    if needs_sort:
+        rows.sort(key=lambda x: (x[0], x[1]))
     return "\n".join([r[2] for r in rows]).strip()
 
 
-def _serialize_part(part: Dict[str, Any]) -> Dict[str, Any]:
-    p = _as_dict(part)
-    time_obj = _as_dict(p.get("time"))
-    state_obj = _as_dict(p.get("state"))
+def _serialize_part(p: Dict[str, Any]) -> Dict[str, Any]:
+    time_obj = p.get("time")
+    state_obj = p.get("state")
 
     out: Dict[str, Any] = {
         "id": p.get("id"),
         "message_id": p.get("messageID"),
         "type": p.get("type"),
-        "time": _safe_json(time_obj) if time_obj else {},
+        "time": time_obj if type(time_obj) is dict and time_obj else {},
     }
 
-    if isinstance(p.get("text"), str):
-        out["text"] = _truncate(p.get("text"))
-    if p.get("tool"):
-        out["tool"] = p.get("tool")
-    if p.get("metadata") is not None:
-        out["metadata"] = _safe_json(p.get("metadata"))
-    if state_obj:
+    text = p.get("text")
+    if isinstance(text, str):
+        out["text"] = _truncate(text)
+    tool = p.get("tool")
+    if tool:
+        out["tool"] = tool
+    metadata = p.get("metadata")
+    if metadata is not None:
+        out["metadata"] = metadata
+    if type(state_obj) is dict and state_obj:
+        output = state_obj.get("output")
+        error = state_obj.get("error")
         out["state"] = {
             "status": state_obj.get("status"),
-            "input": _safe_json(state_obj.get("input")),
-            "output": _truncate(state_obj.get("output")) if isinstance(state_obj.get("output"), str) else _safe_json(state_obj.get("output")),
-            "error": _truncate(state_obj.get("error")) if isinstance(state_obj.get("error"), str) else _safe_json(state_obj.get("error")),
-            "metadata": _safe_json(state_obj.get("metadata")),
+            "input": state_obj.get("input"),
+            "output": _truncate(output) if isinstance(output, str) else output,
+            "error": _truncate(error) if isinstance(error, str) else error,
+            "metadata": state_obj.get("metadata"),
         }
     return out
 
 
 def _append_message_event(state: Dict[str, Any], key: str, info: Dict[str, Any]) -> None:
-    state["message_events"].setdefault(key, [])
-    state["message_events"][key].append(
+    _state_append(
+        state,
+        ("message_events", key),
         {
             "captured_at": _iso_now(),
-            "info": _safe_json(info),
-        }
+            "info": info,
+        },
+        MAX_MESSAGE_EVENTS_PER_MESSAGE,
     )
-    if len(state["message_events"][key]) > MAX_MESSAGE_EVENTS_PER_MESSAGE:
-        state["message_events"][key] = state["message_events"][key][-MAX_MESSAGE_EVENTS_PER_MESSAGE:]
 
 
 def _parts_type_counts(parts_map: Dict[str, Any]) -> Dict[str, int]:
-    counts: Dict[str, int] = {}
-    for part in parts_map.values():
-        ptype = str(_as_dict(part).get("type") or "unknown")
-        counts[ptype] = counts.get(ptype, 0) + 1
-    return counts
+    return dict(Counter(str((part.get("type") if type(part) is dict else None) or "unknown") for part in parts_map.values()))
 
 
 def _build_turn_details(parts_map: Dict[str, Any]) -> Tuple[str, List[Dict[str, Any]], List[Dict[str, Any]]]:
     text_rows: List[Tuple[datetime, str, str]] = []
     reasoning_rows: List[Dict[str, Any]] = []
     tools: List[Dict[str, Any]] = []
+    now = datetime.now(timezone.utc)
+
+    # Parts usually arrive in time order, so only sort a bucket when an
+    # out-of-order (timestamp, id) pair was actually seen.
+    needs_sort_text = needs_sort_reasoning = needs_sort_tools = False
+    prev_text: Optional[Tuple[datetime, str]] = None
+    prev_reasoning: Optional[Tuple[datetime, str]] = None
+    prev_tool: Optional[Tuple[datetime, str]] = None
 
     for part in parts_map.values():
-        p = _as_dict(part)
-        ptype = str(p.get("type") or "")
-        pid = str(p.get("id") or "")
-        time_obj = _as_dict(p.get("time"))
-        ts = _parse_dt(time_obj.get("start")) or datetime.now(timezone.utc)
-
-        if ptype == "text":
-            txt = p.get("text")
-            if isinstance(txt, str) and txt:
-                text_rows.append((ts, pid, txt))
+        if type(part) is not dict:
             continue
+        ptype = part.get("type")
 
-        if ptype == "reasoning":
-            txt = p.get("text")
-            if isinstance(txt, str) and txt:
-                reasoning_rows.append({"id": pid, "text": txt, "timestamp": ts, "meta": _safe_json(p.get("metadata"))})
+        if ptype == "text" or ptype == "reasoning":
+            txt = part.get("text")
+            if not isinstance(txt, str) or not txt:
+                continue
+            time_obj = part.get("time")
+            ts = (_parse_dt(time_obj.get("start")) if type(time_obj) is dict else None) or now
+            pid = str(part.get("id") or "")
+            order = (ts, pid)
+            if ptype == "text":
+                if prev_text is not None and order < prev_text:
+                    needs_sort_text = True
+                prev_text = order
+                text_rows.append((ts, pid, txt))
+            else:
+                if prev_reasoning is not None and order < prev_reasoning:
+                    needs_sort_reasoning = True
+                prev_reasoning = order
+                reasoning_rows.append({"id": pid, "text": txt, "timestamp": ts, "meta": part.get("metadata")})
             continue
 
         if ptype == "tool":
-            state = _as_dict(p.get("state"))
+            state = part.get("state")
+            if type(state) is not dict:
+                continue
             status = str(state.get("status") or "")
             # Emit once tool reaches a terminal state.
-            if status not in {"completed", "error"}:
+            if status != "completed" and status != "error":
                 continue
+            time_obj = part.get("time")
+            ts = (_parse_dt(time_obj.get("start")) if type(time_obj) is dict else None) or now
+            pid = str(part.get("id") or "")
+            order = (ts, pid)
+            if prev_tool is not None and order < prev_tool:
+                needs_sort_tools = True
+            prev_tool = order
             input_obj = state.get("input")
             output_txt = state.get("output") if status == "completed" else state.get("error")
             tools.append(
                 {
                     "id": pid,
-                    "name": p.get("tool") or "tool",
+                    "name": part.get("tool") or "tool",
                     "timestamp": ts,
                     "status": status,
-                    "input": json.dumps(input_obj, ensure_ascii=False) if isinstance(input_obj, (dict, list)) else str(input_obj or ""),
+                    "input": _json_dumps(input_obj).decode("utf-8") if isinstance(input_obj, (dict, list)) else str(input_obj or ""),
                     "output": str(output_txt or ""),
-                    "meta": _safe_json(state.get("metadata")),
+                    "meta": state.get("metadata"),
                 }
             )
 
-    text_rows.sort(key=lambda x: (x[0], x[1]))
-    reasoning_rows.sort(key=lambda x: (x["timestamp"], x["id"]))
-    tools.sort(key=lambda x: (x["timestamp"], x["id"]))
+    if needs_sort_text:
+        text_rows.sort(key=lambda x: (x[0], x[1]))
+    if needs_sort_reasoning:
+        reasoning_rows.sort(key=lambda x: (x["timestamp"], x["id"]))
+    if needs_sort_tools:
+        tools.sort(key=lambda x: (x["timestamp"], x["id"]))
     output_text = "\n".join([r[2] for r in text_rows]).strip()
     return output_text, reasoning_rows, tools
 
 
 def _emit_lifecycle_trace(client: Any, payload: Dict[str, Any], event_name: str, session_id: str) -> None:
     name = f"OpenCode {event_name}"
-    user_id = os.environ.get("LANGFUSE_USER_ID", "opencode-user")
+    user_id = _USER_ID
     metadata = {
         "product": "opencode",
         "reconstruction": "plugin-event-lifecycle",
@@ -445,8 +891,8 @@ def _emit_lifecycle_trace(client: Any, payload: Dict[str, Any], event_name: str,
         "event": event_name,
         "session_id": session_id,
         "user_id": user_id,
-        "hostname": socket.gethostname(),
-        "payload": _safe_json(_event_obj(payload)),
+        "hostname": _HOSTNAME,
+        "payload": _event_obj(payload),
     }
     try:
         with client.start_as_current_span(name=name, metadata=metadata, input=_event_obj(payload)):
@@ -458,7 +904,6 @@ def _emit_lifecycle_trace(client: Any, payload: Dict[str, Any], event_name: str,
                     tags=["opencode", "hook-only", "lifecycle"],
                     metadata=metadata,
                 )
-        client.flush()
     except Exception as exc:
         _log("DEBUG", f"lifecycle emit failed: {exc}")
 
@@ -479,8 +924,19 @@ def _emit_turn_trace(
 ) -> None:
     message_id = str(assistant_info.get("id") or "unknown")
     trace_name = f"OpenCode turn {message_id}"
-    user_id = os.environ.get("LANGFUSE_USER_ID", "opencode-user")
+    user_id = _USER_ID
     created_at = _parse_dt(_as_dict(assistant_info.get("time")).get("created")) or datetime.now(timezone.utc)
+    # Truncate once; the root span and the generation share these payloads.
+    input_message = {"role": "user", "content": _truncate(input_text)}
+    output_message = {"role": "assistant", "content": _truncate(output_text)}
+    provider_id = assistant_info.get("providerID")
+    model_id = assistant_info.get("modelID")
+    agent = assistant_info.get("agent")
+    tokens = assistant_info.get("tokens")
+    usage = tokens if isinstance(tokens, dict) else {}
+    usage_cache = usage.get("cache")
+    if not isinstance(usage_cache, dict):
+        usage_cache = {}
 
     metadata = {
         "product": "opencode",
@@ -488,32 +944,32 @@ def _emit_turn_trace(
         "source": "opencode",
         "session_id": session_id,
         "user_id": user_id,
-        "hostname": socket.gethostname(),
+        "hostname": _HOSTNAME,
         "message_id": message_id,
         "parent_message_id": assistant_info.get("parentID"),
-        "provider_id": assistant_info.get("providerID"),
-        "model_id": assistant_info.get("modelID"),
-        "agent": assistant_info.get("agent"),
+        "provider_id": provider_id,
+        "model_id": model_id,
+        "agent": agent,
         "mode": assistant_info.get("mode"),
         "cost": assistant_info.get("cost"),
-        "tokens": _safe_json(assistant_info.get("tokens")),
+        "tokens": tokens,
         "reasoning_count": len(reasoning),
         "tool_count": len(tools),
         "messages": {
-            "user_info": _safe_json(user_info),
-            "assistant_info": _safe_json(assistant_info),
+            "user_info": user_info,
+            "assistant_info": assistant_info,
         },
         "message_events": {
-            "user": _safe_json(user_message_events),
-            "assistant": _safe_json(assistant_message_events),
+            "user": user_message_events,
+            "assistant": assistant_message_events,
         },
         "message_events_count": {
             "user": len(user_message_events),
             "assistant": len(assistant_message_events),
         },
         "parts": {
-            "user": [_serialize_part(_as_dict(p)) for p in user_parts_map.values()],
-            "assistant": [_serialize_part(_as_dict(p)) for p in assistant_parts_map.values()],
+            "user": [_serialize_part(p) for p in user_parts_map.values() if type(p) is dict],
+            "assistant": [_serialize_part(p) for p in assistant_parts_map.values() if type(p) is dict],
         },
         "parts_count": {
             "user_total": len(user_parts_map),
@@ -526,8 +982,8 @@ def _emit_turn_trace(
     try:
         with client.start_as_current_span(
             name=trace_name,
-            input={"role": "user", "content": _truncate(input_text)},
-            output={"role": "assistant", "content": _truncate(output_text)},
+            input=input_message,
+            output=output_message,
             metadata=metadata,
         ) as root:
             if hasattr(client, "update_current_trace"):
@@ -548,20 +1004,19 @@ def _emit_turn_trace(
 
             if hasattr(client, "start_as_current_generation"):
                 try:
-                    usage = _as_dict(assistant_info.get("tokens"))
                     usage_payload = {
                         "input": int(usage.get("input") or 0),
                         "output": int(usage.get("output") or 0),
                         "total": int(usage.get("total") or 0),
                         "reasoning": int(usage.get("reasoning") or 0),
-                        "input_cache_read": int(_as_dict(usage.get("cache")).get("read") or 0),
+                        "input_cache_read": int(usage_cache.get("read") or 0),
                     }
                     with client.start_as_current_generation(
                         name="assistant_turn",
-                        model=assistant_info.get("modelID"),
-                        input={"role": "user", "content": _truncate(input_text)},
-                        output={"role": "assistant", "content": _truncate(output_text)},
-                        metadata={"provider_id": assistant_info.get("providerID"), "agent": assistant_info.get("agent")},
+                        model=model_id,
+                        input=input_message,
+                        output=output_message,
+                        metadata={"provider_id": provider_id, "agent": agent},
                     ) as gen:
                         gen.update(start_time=t_cursor)
                         gen.update(usage=usage_payload)
@@ -577,33 +1032,43 @@ def _emit_turn_trace(
                 timeline.append((tool.get("timestamp") or t_cursor, "tool", tool))
             timeline.sort(key=lambda x: (x[0], x[1], str(x[2].get("id") or "")))
 
+            # Resolve every child span's arguments first so the emit loop
+            # below is only SDK calls.
+            children: List[Tuple[datetime, Dict[str, Any]]] = []
             for ts, kind, item in timeline:
                 span_start = ts if ts > t_cursor else t_cursor + step
                 if kind == "reasoning":
-                    with client.start_as_current_span(
-                        name=f"reasoning[{item.get('index')}]",
-                        output=_truncate(item.get("text", "")),
-                        metadata={"kind": "reasoning", "meta": item.get("meta")},
-                    ) as span:
-                        span.update(start_time=span_start)
-                    t_cursor = span_start + step
-                    continue
-
-                with client.start_as_current_span(
-                    name=f"tool:{item.get('name') or 'tool'}",
-                    input=_truncate(item.get("input") or ""),
-                    output=_truncate(item.get("output") or ""),
-                    metadata={"kind": "tool", "status": item.get("status"), "meta": item.get("meta")},
-                ) as span:
-                    span.update(start_time=span_start)
+                    span_kwargs = {
+                        "name": f"reasoning[{item.get('index')}]",
+                        "output": _truncate(item.get("text", "")),
+                        "metadata": {"kind": "reasoning", "meta": item.get("meta")},
+                    }
+                else:
+                    span_kwargs = {
+                        "name": f"tool:{item.get('name') or 'tool'}",
+                        "input": _truncate(item.get("input") or ""),
+                        "output": _truncate(item.get("output") or ""),
+                        "metadata": {"kind": "tool", "status": item.get("status"), "meta": item.get("meta")},
+                    }
+                children.append((span_start, span_kwargs))
                 t_cursor = span_start + step
 
-        client.flush()
+            # Detached children avoid a context-var enter/exit per span; older
+            # SDKs without LangfuseSpan.start_span fall back to nested spans.
+            start_child = getattr(root, "start_span", None)
+            for span_start, span_kwargs in children:
+                if start_child is not None:
+                    span = start_child(**span_kwargs)
+                    span.update(start_time=span_start)
+                    span.end()
+                    continue
+                with client.start_as_current_span(**span_kwargs) as span:
+                    span.update(start_time=span_start)
     except Exception as exc:
         _log("DEBUG", f"turn emit failed: {exc}")
 
 
-def _maybe_emit_assistant_turn(client: Any, state: Dict[str, Any], session_id: str, message_id: str, info: Dict[str, Any]) -> None:
+def _maybe_emit_assistant_turn(state: Dict[str, Any], session_id: str, message_id: str, info: Dict[str, Any]) -> None:
     turn_id = _turn_key(session_id, message_id)
     if state["emitted"].get(turn_id):
         return
@@ -617,31 +1082,29 @@ def _maybe_emit_assistant_turn(client: Any, state: Dict[str, Any], session_id: s
     user_parts = _as_dict(state["user_parts"].get(user_key))
     assistant_parts = _as_dict(state["assistant_parts"].get(assistant_key))
 
-    input_text = _extract_text_from_parts(user_parts)
     output_text, reasoning, tools = _build_turn_details(assistant_parts)
     if not output_text and not reasoning and not tools:
-        _log("DEBUG", f"turn skip: no output session={session_id} message={message_id}")
+        if _debug_enabled():
+            _log("DEBUG", f"turn skip: no output session={session_id} message={message_id}")
         return
 
-    _emit_turn_trace(
-        client,
-        session_id,
-        user_info,
-        info,
-        user_message_events,
-        assistant_message_events,
-        user_parts,
-        assistant_parts,
-        input_text,
-        output_text,
-        reasoning,
-        tools,
+    _queue_job(
+        {
+            "kind": "turn",
+            "session_id": session_id,
+            "user_info": user_info,
+            "assistant_info": info,
+            "user_message_events": user_message_events,
+            "assistant_message_events": assistant_message_events,
+            "user_parts": user_parts,
+            "assistant_parts": assistant_parts,
+        }
     )
-    state["emitted"][turn_id] = _iso_now()
+    _state_set(state, ("emitted", turn_id), _iso_now())
     _log(
         "INFO",
         (
-            f"turn emitted session={session_id} turn_id={turn_id} "
+            f"turn queued session={session_id} turn_id={turn_id} "
             f"assistant_message_id={message_id} "
             f"user_message_events={len(user_message_events)} assistant_message_events={len(assistant_message_events)} "
             f"user_parts={len(user_parts)} assistant_parts={len(assistant_parts)} "
@@ -650,32 +1113,33 @@ def _maybe_emit_assistant_turn(client: Any, state: Dict[str, Any], session_id: s
     )
 
     # Keep memory bounded.
-    state["assistant_parts"].pop(assistant_key, None)
-    state["message_events"].pop(assistant_key, None)
-    state["assistant_finish_seen"].pop(assistant_key, None)
+    _state_del(state, ("assistant_parts", assistant_key))
+    _state_del(state, ("message_events", assistant_key))
+    _state_del(state, ("assistant_finish_seen", assistant_key))
     if user_key:
-        state["user_parts"].pop(user_key, None)
-        state["message_events"].pop(user_key, None)
+        _state_del(state, ("user_parts", user_key))
+        _state_del(state, ("message_events", user_key))
 
 
 def _cleanup_emitted_message_buffers(state: Dict[str, Any], session_id: str, message_id: str) -> None:
     key = _msg_key(session_id, message_id)
-    state["assistant_parts"].pop(key, None)
-    state["message_events"].pop(key, None)
-    state["assistant_finish_seen"].pop(key, None)
+    for bucket in ("assistant_parts", "message_events", "assistant_finish_seen"):
+        if key in state[bucket]:
+            _state_del(state, (bucket, key))
 
 
-def _flush_pending_assistant_turns(client: Any, state: Dict[str, Any], session_id: str, reason: str) -> None:
+def _flush_pending_assistant_turns(state: Dict[str, Any], session_id: str, reason: str) -> None:
     if not session_id or session_id == "unknown-session":
         return
 
     prefix = f"{session_id}:"
     emitted_now = 0
     scanned = 0
-    assistant_parts_map = _as_dict(state.get("assistant_parts"))
 
-    for key in list(assistant_parts_map.keys()):
-        if not isinstance(key, str) or not key.startswith(prefix):
+    # State is sharded per session, so every buffered assistant message here
+    # already belongs to this session; the shard itself is the index.
+    for key, parts_map in list(state["assistant_parts"].items()):
+        if not key.startswith(prefix):
             continue
         scanned += 1
         message_id = key[len(prefix):]
@@ -687,39 +1151,37 @@ def _flush_pending_assistant_turns(client: Any, state: Dict[str, Any], session_i
             _cleanup_emitted_message_buffers(state, session_id, message_id)
             continue
 
-        parts_map = _as_dict(assistant_parts_map.get(key))
-        if not parts_map:
+        if not isinstance(parts_map, dict) or not parts_map:
             continue
 
-        info = _as_dict(_as_dict(state.get("messages")).get(key))
+        info = _as_dict(state["messages"].get(key))
         if not info:
             info = {"id": message_id, "role": "assistant", "time": {}, "parentID": ""}
 
         before = bool(state["emitted"].get(turn_id))
-        _maybe_emit_assistant_turn(client, state, session_id, message_id, info)
+        _maybe_emit_assistant_turn(state, session_id, message_id, info)
         after = bool(state["emitted"].get(turn_id))
         if after and not before:
             emitted_now += 1
 
     if emitted_now > 0:
-        _log("INFO", f"flush emitted pending turns session={session_id} reason={reason} scanned={scanned} emitted={emitted_now}")
+        _log("INFO", f"flush queued pending turns session={session_id} reason={reason} scanned={scanned} emitted={emitted_now}")
 
 
-def _handle_message_updated(client: Any, state: Dict[str, Any], payload: Dict[str, Any], session_id: str) -> None:
+def _handle_message_updated(state: Dict[str, Any], payload: Dict[str, Any], session_id: str, event_name: str) -> None:
     info = _as_dict(_event_props(payload).get("info"))
     message_id = str(info.get("id") or "")
     if not message_id:
         return
 
     key = _msg_key(session_id, message_id)
-    event_dt = _event_captured_at(payload)
-    message_last_seen = _as_dict(state.get("message_last_seen"))
-    state["message_last_seen"] = message_last_seen
-    if _is_older_event(message_last_seen, key, event_dt):
+    event_ns = _event_captured_ns(payload)
+    message_last_seen = state["message_last_seen"]
+    if _is_older_event(message_last_seen, key, event_ns):
         return
-    message_last_seen[key] = event_dt.isoformat()
+    _state_set(state, ("message_last_seen", key), event_ns)
 
-    state["messages"][key] = info
+    _state_set(state, ("messages", key), info)
 
     role = str(info.get("role") or "").lower()
     if role == "assistant":
@@ -731,25 +1193,24 @@ def _handle_message_updated(client: Any, state: Dict[str, Any], payload: Dict[st
     _append_message_event(state, key, info)
 
     # Reconcile out-of-order message.part.updated events.
-    pending = _as_dict(state["pending_parts"].pop(key, {}))
-    if pending:
-        if role in {"assistant", "user"}:
-            bucket = "assistant_parts" if role == "assistant" else "user_parts"
-            state[bucket].setdefault(key, {}).update(pending)
-        else:
-            state["pending_parts"][key] = pending
+    pending = _as_dict(state["pending_parts"].get(key))
+    if pending and role in {"assistant", "user"}:
+        bucket = "assistant_parts" if role == "assistant" else "user_parts"
+        for pending_id, pending_part in pending.items():
+            _state_set(state, (bucket, key, pending_id), pending_part)
+        _state_del(state, ("pending_parts", key))
 
     if role != "assistant":
         return
 
     completed = bool(_as_dict(info.get("time")).get("completed"))
     if completed:
-        state["assistant_finish_seen"][key] = _iso_now()
+        _state_set(state, ("assistant_finish_seen", key), _iso_now())
     if completed:
-        _maybe_emit_assistant_turn(client, state, session_id, message_id, info)
+        _maybe_emit_assistant_turn(state, session_id, message_id, info)
 
 
-def _handle_message_part_updated(client: Any, state: Dict[str, Any], payload: Dict[str, Any], session_id: str) -> None:
+def _handle_message_part_updated(state: Dict[str, Any], payload: Dict[str, Any], session_id: str, event_name: str) -> None:
     part = _as_dict(_event_props(payload).get("part"))
     message_id = str(part.get("messageID") or "")
     part_id = str(part.get("id") or "")
@@ -757,13 +1218,12 @@ def _handle_message_part_updated(client: Any, state: Dict[str, Any], payload: Di
         return
 
     key = _msg_key(session_id, message_id)
-    event_dt = _event_captured_at(payload)
+    event_ns = _event_captured_ns(payload)
     part_key = f"{key}:{part_id}"
-    part_last_seen = _as_dict(state.get("part_last_seen"))
-    state["part_last_seen"] = part_last_seen
-    if _is_older_event(part_last_seen, part_key, event_dt):
+    part_last_seen = state["part_last_seen"]
+    if _is_older_event(part_last_seen, part_key, event_ns):
         return
-    part_last_seen[part_key] = event_dt.isoformat()
+    _state_set(state, ("part_last_seen", part_key), event_ns)
 
     turn_id = _turn_key(session_id, message_id)
     if state["emitted"].get(turn_id):
@@ -780,92 +1240,188 @@ def _handle_message_part_updated(client: Any, state: Dict[str, Any], payload: Di
             role = "assistant"
         elif part_type == "text":
             # Keep text parts pending until we know whether this message is user/assistant.
-            state["pending_parts"].setdefault(key, {})
-            state["pending_parts"][key][part_id] = part
+            _state_set(state, ("pending_parts", key, part_id), part)
             return
 
     bucket = "assistant_parts" if role == "assistant" else "user_parts"
-    state[bucket].setdefault(key, {})
-    state[bucket][key][part_id] = part
+    _state_set(state, (bucket, key, part_id), part)
 
     if role == "assistant":
         if part_type == "step-finish":
-            state["assistant_finish_seen"][key] = _iso_now()
+            _state_set(state, ("assistant_finish_seen", key), _iso_now())
         completed = bool(_as_dict(msg.get("time")).get("completed")) if msg else False
-        finish_seen = bool(_as_dict(state.get("assistant_finish_seen")).get(key))
+        finish_seen = bool(state["assistant_finish_seen"].get(key))
         if completed or finish_seen:
-            _maybe_emit_assistant_turn(client, state, session_id, message_id, msg or {"id": message_id, "role": "assistant"})
+            _maybe_emit_assistant_turn(state, session_id, message_id, msg or {"id": message_id, "role": "assistant"})
+
+
+def _emit_job(client: Any, job: Dict[str, Any]) -> None:
+    kind = job.get("kind")
+    session_id = str(job.get("session_id") or "unknown-session")
+    if kind == "lifecycle":
+        _emit_lifecycle_trace(client, _as_dict(job.get("payload")), str(job.get("event_name") or ""), session_id)
+        return
+    if kind != "turn":
+        return
+    user_parts = _as_dict(job.get("user_parts"))
+    assistant_parts = _as_dict(job.get("assistant_parts"))
+    output_text, reasoning, tools = _build_turn_details(assistant_parts)
+    _emit_turn_trace(
+        client,
+        session_id,
+        _as_dict(job.get("user_info")),
+        _as_dict(job.get("assistant_info")),
+        job.get("user_message_events") or [],
+        job.get("assistant_message_events") or [],
+        user_parts,
+        assistant_parts,
+        _extract_text_from_parts(user_parts),
+        output_text,
+        reasoning,
+        tools,
+    )
+
+
+def _drop_legacy_state() -> None:
+    # The pre-shard state.json keys its turns by the old sha256 turn ids, so
+    # carrying its buffers over could re-emit turns that were already sent.
+    # Turns still pending in it at upgrade time are dropped instead.
+    removed = False
+    for path in LEGACY_STATE_FILES:
+        try:
+            path.unlink()
+            removed = True
+        except FileNotFoundError:
+            pass
+        except Exception as exc:
+            _log("DEBUG", f"legacy state cleanup failed path={path}: {exc}")
+    if removed:
+        _log("INFO", "removed pre-shard state.json; turns still buffered in it were not migrated")
+
+
+def flush_main() -> None:
+    """Drain the outbox into Langfuse. Runs detached from the hook, one instance at a time."""
+    _load_dotenv()
+    while True:
+        with _file_lock(FLUSH_LOCK_FILE):
+            _drop_legacy_state()
+            if not OUTBOX_FILE.exists():
+                return
+            # Build the client before claiming: the hook has already marked these
+            # turns emitted, so a claimed job that cannot be sent is lost for good.
+            client = _get_client()
+            if client is None:
+                _log("ERROR", "flush deferred: langfuse client unavailable, outbox left in place")
+                return
+            while True:
+                jobs = _claim_outbox()
+                if not jobs:
+                    break
+                for job in jobs:
+                    _emit_job(client, job)
+                # If the flusher dies mid-batch, the SDK's own shutdown hook at
+                # exit ships what it buffered; this covers the normal path.
+                _flush_client()
+                _log("INFO", f"flush emitted jobs={len(jobs)}")
+        # Hooks do not spawn a flusher while we hold flush.lock, so jobs
+        # appended after our last claim are ours to pick up.
+        if not OUTBOX_FILE.exists():
+            return
+
+
+def _flush_after_part(state: Dict[str, Any], payload: Dict[str, Any], session_id: str, event_name: str) -> None:
+    # Parts can land after the session went idle; flush them right away.
+    last_event = str(state["lifecycle"].get("event") or "")
+    if last_event in _FLUSH_EVENTS:
+        _flush_pending_assistant_turns(state, session_id, f"{last_event}:post-part")
+
+
+def _record_lifecycle(state: Dict[str, Any], payload: Dict[str, Any], session_id: str, event_name: str) -> None:
+    # Lifecycle events for a session are serialized by its state lock,
+    # so the marker is a plain journaled field of the session state.
+    event_ns = _event_captured_ns(payload)
+    prev_ns = state["lifecycle"].get("at_ns")
+    if type(prev_ns) is not int or event_ns >= prev_ns:
+        _state_set(state, ("lifecycle",), {"event": event_name, "at_ns": event_ns})
+
+
+def _flush_on_lifecycle(state: Dict[str, Any], payload: Dict[str, Any], session_id: str, event_name: str) -> None:
+    _flush_pending_assistant_turns(state, session_id, event_name)
+
+
+def _queue_lifecycle_job(state: Dict[str, Any], payload: Dict[str, Any], session_id: str, event_name: str) -> None:
+    _queue_job({"kind": "lifecycle", "session_id": session_id, "event_name": event_name, "payload": _event_obj(payload)})
+
+
+# Steps run in order under the session lock, all with the same signature.
+# Events missing from this table never touch state (e.g. message.removed,
+# message.part.removed), so main() returns before taking the lock for them.
+_EventHandler = Callable[[Dict[str, Any], Dict[str, Any], str, str], None]
+_EVENT_HANDLERS: Dict[str, Tuple[_EventHandler, ...]] = {
+    "message.updated": (_handle_message_updated,),
+    "message.part.updated": (_handle_message_part_updated, _flush_after_part),
+    "session.created": (_record_lifecycle, _queue_lifecycle_job),
+    "session.idle": (_record_lifecycle, _flush_on_lifecycle, _queue_lifecycle_job),
+    "session.error": (_record_lifecycle, _flush_on_lifecycle, _queue_lifecycle_job),
+    "session.compacted": (_record_lifecycle, _flush_on_lifecycle, _queue_lifecycle_job),
+}
+
+
+def _tracing_enabled() -> bool:
+    return os.environ.get("TRACE_TO_LANGFUSE", "").strip().lower() == "true"
 
 
 def main() -> None:
+    # .env never overrides variables that are already set, so an explicit
+    # non-"true" flag in the environment cannot be flipped by it: bail
+    # before touching the file or stdin.
+    if "TRACE_TO_LANGFUSE" in os.environ and not _tracing_enabled():
+        return
     _load_dotenv()
+    if not _tracing_enabled():
+        return
 
-    if os.environ.get("TRACE_TO_LANGFUSE", "").strip().lower() != "true":
+    if _credentials() is None or not _sdk_available():
         return
 
     payload = _read_payload()
     if not payload:
         return
 
-    client = _build_client()
-    if client is None:
-        return
-
     event_name = _event_name(payload)
     session_id = _session_id(payload)
-    _log("DEBUG", f"event={event_name} session={session_id}")
-    with _state_lock():
-        state = _load_state()
-        lifecycle_map = _as_dict(state.get("session_lifecycle"))
-        state["session_lifecycle"] = lifecycle_map
-
-        if event_name == "message.updated":
-            _handle_message_updated(client, state, payload, session_id)
-        elif event_name == "message.part.updated":
-            _handle_message_part_updated(client, state, payload, session_id)
-            last = _as_dict(lifecycle_map.get(session_id))
-            last_event = str(last.get("event") or "")
-            if last_event in {"session.idle", "session.error", "session.compacted"}:
-                _flush_pending_assistant_turns(client, state, session_id, f"{last_event}:post-part")
-        elif event_name in {"message.removed", "message.part.removed"}:
-            # Best-effort cleanup events can be handled later if needed.
-            pass
+    if _debug_enabled():
+        _log("DEBUG", f"event={event_name} session={session_id}")
+    handlers = _EVENT_HANDLERS.get(event_name)
+    if not handlers:
+        return
+    with _state_lock(session_id):
+        state = _load_session_state(session_id)
+        for handler in handlers:
+            handler(state, payload, session_id, event_name)
 
-        if event_name in {"session.created", "session.idle", "session.error", "session.compacted"}:
-            event_dt = _event_captured_at(payload)
-            prev = _as_dict(lifecycle_map.get(session_id))
-            prev_dt = _parse_dt(prev.get("at"))
-            if prev_dt is None or event_dt >= prev_dt:
-                lifecycle_map[session_id] = {"event": event_name, "at": event_dt.isoformat()}
-
-        if event_name in {"session.idle", "session.error", "session.compacted"}:
-            _flush_pending_assistant_turns(client, state, session_id, event_name)
-
-        if event_name in {"session.created", "session.idle", "session.error", "session.compacted"}:
-            _emit_lifecycle_trace(client, payload, event_name, session_id)
-
-        _save_state(state)
-        _log(
-            "DEBUG",
-            (
-                "state-saved "
-                f"messages={len(_as_dict(state.get('messages')))} "
-                f"message_events={len(_as_dict(state.get('message_events')))} "
-                f"user_parts={len(_as_dict(state.get('user_parts')))} "
-                f"assistant_parts={len(_as_dict(state.get('assistant_parts')))} "
-                f"assistant_finish_seen={len(_as_dict(state.get('assistant_finish_seen')))} "
-                f"pending_parts={len(_as_dict(state.get('pending_parts')))} "
-                f"emitted={len(_as_dict(state.get('emitted')))}"
-            ),
-        )
+        flush_due = _commit_outbox()
+
+        _commit_state(session_id, state)
+        if _debug_enabled():
+            counts = " ".join(f"{key}={len(state[key])}" for key in _STATE_SAVED_LOG_KEYS)
+            _log("DEBUG", f"state-saved {counts}")
+
+    if flush_due:
+        _spawn_flusher()
 
 
 if __name__ == "__main__":
     try:
-        main()
+        if "--flush" in sys.argv[1:]:
+            flush_main()
+        else:
+            main()
     except Exception as exc:
         try:
-            _load_dotenv()
+            # Only reached before main() loaded it when it failed very early.
+            if not _DOTENV_LOADED:
+                _load_dotenv()
             _log("ERROR", f"fatal exception: {exc}")
         except Exception:
             pass